@@ -1,17 +1,66 @@
 import streamlit as st
-from transformers import pipeline
+import os
+import re
+import html
 import time
-import base64
-from gtts import gTTS
-import io
+import queue
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# torch, transformers and gtts are imported inside the functions that use them,
+# so the page and the loading spinner render before those heavy imports run.
+
+# Size the OpenMP/MKL pools to physical cores; hyperthread siblings only
+# oversubscribe and thrash shared caches. Must be set before torch is imported.
+cpu_count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+os.environ.setdefault("OMP_NUM_THREADS", str(max(cpu_count // 2, 1)))
+os.environ.setdefault("MKL_NUM_THREADS", os.environ["OMP_NUM_THREADS"])
+
+# Set CACHE_DIR to a persistent volume (e.g. /data) to keep the model weights and
+# synthesized speech across restarts. Must be set before transformers is imported.
+CACHE_DIR = os.environ.get("CACHE_DIR")
+if CACHE_DIR:
+    os.environ.setdefault("HF_HOME", os.path.join(CACHE_DIR, "hf"))
+
+# Must be the first Streamlit command: the model loaders below show spinners
+st.set_page_config(page_title="🌾 Rice Disease Q&A Assistant", layout="centered")
 
 # -------------------------------
 # 1. Load Q&A Model
 # -------------------------------
 
-@st.cache_resource
+@st.cache_resource(show_spinner="Loading the Q&A model...")
 def load_qa_model():
-    return pipeline("question-answering", model="distilbert-base-uncased-distilled-squad")
+    import torch
+    from transformers import pipeline
+
+    torch.set_num_threads(int(os.environ["OMP_NUM_THREADS"]))
+    # The inter-op pool can only be sized once per process, and this loader can
+    # run again (cache cleared from the menu, code edited in development), so
+    # only set it if it has not been set yet
+    if torch.get_num_interop_threads() != 1:
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # inter-op work already started; keep the existing pool
+
+    if torch.cuda.is_available():
+        # fp16 on the GPU; int8 dynamic quantization only has CPU kernels
+        qa = pipeline("question-answering", model="distilbert-base-uncased-distilled-squad",
+                      use_fast=True, device=0, torch_dtype=torch.float16)
+    else:
+        # The fast (Rust) tokenizer is required: answers are mapped back to the
+        # section text through its offset mappings
+        qa = pipeline("question-answering", model="distilbert-base-uncased-distilled-squad", use_fast=True)
+        # Dynamic int8 quantization of the Linear layers: the CPU forward pass is
+        # dominated by these matmuls, so int8 weights roughly halve their cost
+        qa.model = torch.quantization.quantize_dynamic(qa.model, {torch.nn.Linear}, dtype=torch.qint8)
+    return qa
 
 qa_pipeline = load_qa_model()
 
@@ -19,15 +68,77 @@ qa_pipeline = load_qa_model()
 # 2. Text-to-Speech Function
 # -------------------------------
 
-def text_to_speech(text):
-    """Convert text to speech and return audio data as base64"""
+TTS_CACHE_DIR = os.path.join(CACHE_DIR, "tts") if CACHE_DIR else ".tts_cache"
+# Least recently used clips are deleted beyond this many files
+TTS_CACHE_MAX_FILES = 512
+
+def load_or_synthesize(text):
+    """Return MP3 bytes for text, from the on-disk cache or a fresh gTTS call.
+
+    Files are keyed by the SHA-1 of the text, so the cache survives process
+    restarts. Errors propagate and nothing is written for a failed call.
+    Runs on the TTS worker threads, so it must not call any Streamlit API.
+    """
+    path = os.path.join(TTS_CACHE_DIR, hashlib.sha1(text.encode()).hexdigest() + ".mp3")
     try:
-        tts = gTTS(text=text, lang='en', slow=False)
-        audio_buffer = io.BytesIO()
-        tts.write_to_fp(audio_buffer)
-        audio_buffer.seek(0)
-        audio_base64 = base64.b64encode(audio_buffer.read()).decode()
-        return audio_base64
+        with open(path, "rb") as f:
+            mp3 = f.read()
+    except FileNotFoundError:
+        pass
+    else:
+        try:
+            os.utime(path)  # mark as recently used for eviction
+        except FileNotFoundError:
+            pass  # evicted by another thread since the read
+        return mp3
+
+    from gtts import gTTS
+
+    tts = gTTS(text=text, lang='en', slow=False)
+    mp3 = b"".join(tts.stream())
+
+    # Write to a unique temp file, then rename: sessions and TTS workers are
+    # threads of one process, so each writer needs its own file, and readers
+    # only ever see a complete clip
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(mp3)
+    os.replace(tmp_path, path)
+    prune_tts_cache()
+    return mp3
+
+def prune_tts_cache():
+    """Delete the least recently used clips beyond TTS_CACHE_MAX_FILES"""
+    clips = []
+    for entry in os.scandir(TTS_CACHE_DIR):
+        if entry.name.endswith(".mp3"):
+            try:
+                clips.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass  # removed by another thread while scanning
+    if len(clips) <= TTS_CACHE_MAX_FILES:
+        return
+    clips.sort()
+    for _, path in clips[:-TTS_CACHE_MAX_FILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # already removed by another thread
+
+@st.cache_resource
+def get_tts_pool():
+    """Worker threads for speech synthesis, shared by every session"""
+    return ThreadPoolExecutor(max_workers=4)
+
+def start_text_to_speech(text):
+    """Start synthesizing text in the background and return a Future"""
+    return get_tts_pool().submit(load_or_synthesize, text)
+
+def text_to_speech_result(future):
+    """Wait for a synthesis Future and return the MP3 bytes"""
+    try:
+        return future.result()
     except Exception as e:
         st.error(f"Error generating audio: {e}")
         return None
@@ -52,19 +163,206 @@ sections = {
     "tungro": """Rice Tungro Virus is a dual infection caused by Rice Tungro Bacilliform and Spherical Viruses..."""
 }
 
+# Single compiled pattern over all disease keywords: one C-level scan per question.
+# Longer keywords come first so "narrow brown spot" wins over "brown spot";
+# plurals ("brown spots", "sheath blights") still match their keyword.
+keyword_alternation = "|".join(re.escape(keyword) for keyword in sorted(sections, key=len, reverse=True))
+keyword_pattern = re.compile(r"\b(" + keyword_alternation + r")(?:e?s)?\b", re.IGNORECASE)
+
+# Overview questions that name nothing but the disease ("What is rice blast?",
+# "What causes tungro?", "Describe brown spot") are answered with the opening
+# sentence of the section, without a model call. Anything more specific
+# ("What are the symptoms of ...?") goes to the model.
+overview_pattern = re.compile(
+    r"^\s*(?:what\s+(?:is|are|causes)|define|describe|tell\s+me\s+about)\s+(?:the\s+)?"
+    r"(?:" + keyword_alternation + r")(?:e?s)?\s*[?.!]*\s*$",
+    re.IGNORECASE,
+)
+# A sentence ends at . ! or ? followed by a capitalised word (so "pv. oryzae" does not split)
+first_sentence_pattern = re.compile(r".+?[.!?]+(?=\s+[A-Z]|\s*$)", re.DOTALL)
+
+def first_sentence(text):
+    """Return the opening sentence of a section"""
+    match = first_sentence_pattern.match(text)
+    return match.group(0) if match else text
+
+@st.cache_resource
+def encode_sections():
+    """Tokenize every section once; only the question is tokenized per query"""
+    tokenizer = qa_pipeline.tokenizer
+    encodings = {}
+    for disease, text in sections.items():
+        encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        encodings[disease] = {
+            "input_ids": encoding["input_ids"],
+            "offset_mapping": encoding["offset_mapping"],
+            # Word index of each token, used to widen answers to whole words
+            "word_ids": encoding.word_ids(),
+        }
+    return encodings
+
+class QABatcher:
+    """Coalesce concurrent QA requests into one padded forward pass.
+
+    Streamlit runs each session's script in its own thread. Requests that
+    arrive within max_wait seconds of each other, up to max_batch of them,
+    are answered together on a background worker thread, with one model call
+    per group of similar-length sequences.
+    """
+
+    def __init__(self, qa, encodings, max_batch=8, max_wait=0.01,
+                 bucket_width=32, max_seq_len=256, max_question_len=64, max_answer_len=15):
+        self.tokenizer = qa.tokenizer
+        self.model = qa.model
+        self.encodings = encodings
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.bucket_width = bucket_width
+        self.max_seq_len = max_seq_len
+        self.max_question_len = max_question_len
+        self.max_answer_len = max_answer_len
+        self.requests = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, question, disease):
+        """Queue a question against a disease section; returns a Future for the answer"""
+        future = Future()
+        self.requests.put((question, disease, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                answers = self._answer_batch([(question, disease) for question, disease, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+            else:
+                for (_, _, future), answer in zip(batch, answers):
+                    future.set_result(answer)
+
+    def _encode(self, question, disease):
+        """Build [CLS] question [SEP] context [SEP], reusing the pre-tokenized context.
+
+        Sequences are capped at max_seq_len tokens: attention cost grows with the
+        square of the length, and the sections fit well within it.
+        """
+        tokenizer = self.tokenizer
+        context = self.encodings[disease]
+        question_ids = tokenizer(question, add_special_tokens=False)["input_ids"][:self.max_question_len]
+        context_len = min(len(context["input_ids"]), self.max_seq_len - len(question_ids) - 3)
+        input_ids = (
+            [tokenizer.cls_token_id] + question_ids + [tokenizer.sep_token_id]
+            + context["input_ids"][:context_len] + [tokenizer.sep_token_id]
+        )
+        return input_ids, len(question_ids) + 2, context_len
+
+    def _answer_batch(self, items):
+        encoded = [self._encode(question, disease) for question, disease in items]
+
+        # Sort by length and split wherever lengths drift more than bucket_width
+        # tokens apart, so short requests are not padded to the longest one
+        buckets = []
+        for i in sorted(range(len(items)), key=lambda i: len(encoded[i][0])):
+            if buckets and len(encoded[i][0]) - len(encoded[buckets[-1][0]][0]) <= self.bucket_width:
+                buckets[-1].append(i)
+            else:
+                buckets.append([i])
+
+        answers = [None] * len(items)
+        for bucket in buckets:
+            bucket_answers = self._forward([items[i][1] for i in bucket], [encoded[i] for i in bucket])
+            for i, answer in zip(bucket, bucket_answers):
+                answers[i] = answer
+        return answers
+
+    def _forward(self, diseases, encoded):
+        import torch
+
+        # Pad every row to the longest sequence in the bucket
+        max_len = max(len(input_ids) for input_ids, _, _ in encoded)
+        input_ids = torch.full((len(encoded), max_len), self.tokenizer.pad_token_id)
+        attention_mask = torch.zeros((len(encoded), max_len), dtype=torch.long)
+        for row, (ids, _, _) in enumerate(encoded):
+            input_ids[row, :len(ids)] = torch.tensor(ids)
+            attention_mask[row, :len(ids)] = 1
+
+        with torch.inference_mode():
+            outputs = self.model(
+                input_ids=input_ids.to(self.model.device),
+                attention_mask=attention_mask.to(self.model.device),
+            )
+
+        answers = []
+        for row, (disease, (_, context_start, context_len)) in enumerate(zip(diseases, encoded)):
+            # Best span inside the context: maximize start + end logit over
+            # start <= end < start + max_answer_len, as the pipeline does
+            start_logits = outputs.start_logits[row, context_start:context_start + context_len].float().cpu()
+            end_logits = outputs.end_logits[row, context_start:context_start + context_len].float().cpu()
+            valid = torch.ones(context_len, context_len).triu().tril(self.max_answer_len - 1).bool()
+            scores = (start_logits[:, None] + end_logits[None, :]).masked_fill(~valid, float("-inf"))
+            start, end = divmod(int(scores.argmax()), context_len)
+
+            # Widen the span to whole words, like the pipeline's align_to_words,
+            # so "Xanthomonas" is not returned as a few of its WordPiece tokens
+            word_ids = self.encodings[disease]["word_ids"]
+            while start > 0 and word_ids[start - 1] == word_ids[start]:
+                start -= 1
+            while end + 1 < len(word_ids) and word_ids[end + 1] == word_ids[end]:
+                end += 1
+
+            offsets = self.encodings[disease]["offset_mapping"]
+            answers.append(sections[disease][offsets[start][0]:offsets[end][1]])
+        return answers
+
+QA_CHECK_QUESTIONS = [
+    ("Which bacterium causes the disease?", "bacterial leaf blight"),
+    ("Which fungus causes it?", "rice blast"),
+    ("What is it caused by?", "sheath blight"),
+    ("What spreads the virus?", "grassy stunt"),
+]
+
+@st.cache_resource(show_spinner="Warming up the Q&A model...")
+def get_qa_batcher():
+    """One batcher per process, shared by every session"""
+    batcher = QABatcher(qa_pipeline, encode_sections())
+    # Warm-up passes through the same padded, masked forward that real requests
+    # take (single and batched), so weight paging and kernel selection happen
+    # here, once per process, rather than on the first user question
+    for batch_size in (1, 2):
+        batcher._answer_batch([("What causes it?", disease) for disease in list(sections)[:batch_size]])
+
+    # The batcher reimplements the pipeline's input building and span
+    # extraction; cross-check both on a few questions so any drift shows up
+    # in the logs at startup
+    for question, disease in QA_CHECK_QUESTIONS:
+        expected = qa_pipeline(question=question, context=sections[disease])["answer"]
+        actual = batcher._answer_batch([(question, disease)])[0]
+        if actual != expected:
+            logger.warning("QA batcher answered %r for %r (%s); the pipeline answered %r",
+                           actual, question, disease, expected)
+    return batcher
+
+qa_batcher = get_qa_batcher()
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def answer_question(question, disease):
+    """Run the QA model on a disease section; cached per (question, disease)"""
+    return qa_batcher.submit(question, disease).result()
+
 # -------------------------------
-# 4. Page Config and Styling
+# 4. Styling
 # -------------------------------
 
-st.set_page_config(page_title="🌾 Rice Disease Q&A Assistant", layout="centered")
-
 st.markdown("""
 <style>
-.chat-container {
-    max-width: 700px;
-    margin: auto;
-    padding: 10px;
-}
 .msg {
     border-radius: 12px;
     padding: 10px 15px;
@@ -86,25 +384,6 @@ st.markdown("""
     font-weight: bold;
     color: #555;
 }
-.audio-controls {
-    margin-top: 10px;
-    padding: 8px;
-    background-color: #f8f9fa;
-    border-radius: 8px;
-    border: 1px solid #e9ecef;
-}
-.audio-btn {
-    background-color: #007bff;
-    color: white;
-    border: none;
-    padding: 5px 10px;
-    border-radius: 4px;
-    cursor: pointer;
-    margin-right: 5px;
-}
-.audio-btn:hover {
-    background-color: #0056b3;
-}
 </style>
 """, unsafe_allow_html=True)
 
@@ -130,37 +409,90 @@ with st.sidebar:
 # 6. Display Chat History with Audio
 # -------------------------------
 
-st.markdown("<div class='chat-container'>", unsafe_allow_html=True)
+def message_html(msg):
+    """Return the HTML for one chat bubble.
 
-for i, msg in enumerate(st.session_state.history):
+    The role and content are escaped: bubbles are joined into one markdown
+    element, so stray markup in one message would otherwise break every
+    bubble after it.
+    """
     role_class = "user" if msg["role"] == "user" else "bot"
-    st.markdown(
-        f"""
-        <div class='msg {role_class}'>
-            <div class='role'>{msg["role"].capitalize()}</div>
-            <div>{msg["content"]}</div>
-        </div>
-        """, unsafe_allow_html=True
+    return (
+        f"<div class='msg {role_class}'>"
+        f"<div class='role'>{html.escape(msg['role'].capitalize())}</div>"
+        f"<div>{html.escape(msg['content'])}</div>"
+        f"</div>"
     )
-    
-    # Add audio controls for bot messages
-    if msg["role"] == "bot" and st.session_state.audio_enabled:
-        # Generate audio for this message
-        audio_data = text_to_speech(msg["content"])
-        
-        if audio_data:
-            # Create audio player
-            audio_html = f"""
-            <div class='audio-controls'>
-                <audio controls style="width: 100%;">
-                    <source src="data:audio/mp3;base64,{audio_data}" type="audio/mp3">
-                    Your browser does not support the audio element.
-                </audio>
-            </div>
-            """
-            st.markdown(audio_html, unsafe_allow_html=True)
-
-st.markdown("</div>", unsafe_allow_html=True)
+
+def render_messages(messages):
+    """Render chat bubbles, plus audio players for bot messages.
+
+    Consecutive bubbles are joined into a single markdown element; the HTML is
+    only split where an audio player has to be placed between two messages.
+
+    Audio is synthesized once per bot message and stored with it. Messages
+    without an "audio" key yet (new answers, the greeting, answers added while
+    audio was off) get a placeholder: their synthesis starts before drawing,
+    once per distinct text, and the players are filled in after all the text
+    is on screen. Failed attempts are stored as None so they are not retried
+    every rerun.
+    """
+    audio_enabled = st.session_state.audio_enabled
+    futures = {}
+    if audio_enabled:
+        for msg in messages:
+            if msg["role"] == "bot" and "audio" not in msg and msg["content"] not in futures:
+                futures[msg["content"]] = start_text_to_speech(msg["content"])
+
+    pending = []
+    slots = []
+    for msg in messages:
+        pending.append(message_html(msg))
+
+        # Add audio controls for bot messages
+        if msg["role"] == "bot" and audio_enabled and ("audio" not in msg or msg["audio"]):
+            st.markdown("".join(pending), unsafe_allow_html=True)
+            pending = []
+            if "audio" in msg:
+                render_audio(msg["audio"])
+            else:
+                slots.append((msg, st.empty()))
+
+    if pending:
+        st.markdown("".join(pending), unsafe_allow_html=True)
+
+    results = {}
+    for msg, slot in slots:
+        if msg["content"] not in results:
+            results[msg["content"]] = text_to_speech_result(futures[msg["content"]])
+        msg["audio"] = results[msg["content"]]
+        with slot:
+            render_audio(msg["audio"])
+
+def render_audio(audio_data):
+    """Render an audio player for MP3 bytes, if there are any"""
+    if audio_data:
+        # Served from Streamlit's media endpoint rather than inlined as base64
+        st.audio(audio_data, format="audio/mp3")
+
+# Only the most recent messages are drawn by default; older ones (and their
+# audio) are only rendered when the user asks for them
+HISTORY_WINDOW = 20
+
+# One container holds the whole conversation; new turns are appended to it
+# directly instead of redrawing the history
+chat_container = st.container()
+
+with chat_container:
+    history = st.session_state.history
+    earlier = history[:-HISTORY_WINDOW]
+    # Fixed label and key: the widget keeps its state as the history grows
+    if earlier and st.toggle("Show earlier messages", key="show_earlier"):
+        visible = history
+    else:
+        visible = history[-HISTORY_WINDOW:]
+
+    render_messages(visible)
 
 # -------------------------------
 # 7. Chat Input (Pinned Below)
@@ -169,27 +501,30 @@ st.markdown("</div>", unsafe_allow_html=True)
 question = st.chat_input("Type your question about rice diseases...")
 
 if question:
-    # Store user message
-    st.session_state.history.append({"role": "user", "content": question})
+    # Store and show user message
+    user_msg = {"role": "user", "content": question}
+    st.session_state.history.append(user_msg)
+    with chat_container:
+        render_messages([user_msg])
 
     # Process the question
     with st.spinner("Analyzing your question..."):
-        selected_context = None
-        for keyword, section in sections.items():
-            if keyword in question.lower():
-                selected_context = section
-                break
-
-        time.sleep(1)  # small delay for realism
+        match = keyword_pattern.search(question)
 
-        if selected_context:
-            result = qa_pipeline(question=question, context=selected_context)
-            answer = result["answer"]
+        if match:
+            disease = match.group(1).lower()
+            if overview_pattern.match(question):
+                answer = first_sentence(sections[disease])
+            else:
+                answer = answer_question(question, disease)
         else:
             answer = "I couldn't match your question to a specific disease. Try including the name, like 'blast', 'blight', or 'tungro'."
 
-    # Add bot response to history
-    st.session_state.history.append({"role": "bot", "content": answer})
+    # Add bot response to history and render only the new bubble; earlier
+    # messages were already drawn above, so no rerun is needed. The text is
+    # shown right away and its audio player is added once synthesis finishes.
+    bot_msg = {"role": "bot", "content": answer}
+    st.session_state.history.append(bot_msg)
+    with chat_container:
+        render_messages([bot_msg])
 
-    # Rerun to refresh chat
-    st.rerun()